@@ -29,6 +29,11 @@ GOAT_BIN = 'etap_dalitz'
 GOAT_CONFIG = '/dev/null'  # relative path to GOAT_PATH (e. g. "configfiles/GoAT-Analysis.dat") or /dev/null for no config file
 INPUT_FILE_PREFIX = 'Goat_merged'
 OUTPUT_FILE_PREFIX = 'Analysis'
+COMPRESSION_INTERMEDIATE = None  # ROOT compression setting for files merged before the analysis (written once, read many times), e. g. 'lz4' or 'none'; None keeps the hadd default
+COMPRESSION_FINAL = None  # ROOT compression setting for merged analysis files and the ROOT output of the plots, e. g. 'zstd' or 'lzma'; None keeps the default
+MIN_FILE_SIZE = 1024  # input files smaller than this (in bytes) are treated as empty by the pre-flight check
+NORMALISATION_TREE = ''  # name of the tree whose entries are used to normalise the histograms of a channel; leave blank to use the tree with the most entries
+INDEX_FILE = 'file_index.json'  # cache of per-file metadata like event counts, stored in the output directory
 ROOTSYS = ''#'/opt/root-6.04.00'  # alternative ROOTSYS which should be used instead of the (probably) local defined ROOTSYS environmental variable; leave blank if the usual ROOTSYS should be used, i. e. ROOTSYS = ''
 
 # End of user changes
@@ -41,12 +46,18 @@ import logging
 import datetime
 import subprocess
 import fileinput
-from shutil import copyfile, move
+from shutil import copyfile, move, rmtree
 from os.path import join as pjoin
 from math import sqrt, ceil
+from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy  # used to make copies of histograms that they won't get deleted after closing the file
 # import module which provides colored output
 from color import *
+from staging import Stager, parse_size
+from file_index import FileIndex
+from preflight import preflight, quarantine_files, check_root_file
+from progress import Progress, ProgressHandler
 
 
 logging.setLoggerClass(ColoredLogger)
@@ -176,6 +187,12 @@ def get_path(path, file=None):
     else:
         return os.path.expanduser(path)
 
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
 def replace_all(file, search_exp, replace_exp, number_replacements=0):
     if number_replacements < 0:
         raise ValueError('Negative number of replacements submitted')
@@ -206,7 +223,39 @@ def run(cmd, logfile, error=False):
     return p.wait()
 
 def timestamp():
-    return '[%s] ' % str(datetime.datetime.now()).split('.')[0]
+    return '[%s] ' % format_time()
+
+# ROOT compression settings are given as 100*algorithm + level,
+# the names below map to the settings recommended by ROOT
+COMPRESSION_ALGORITHMS = {
+    'none': 0,
+    'zlib': 101,
+    'lzma': 207,
+    'lz4': 404,
+    'zstd': 505
+}
+
+def compression_setting(value):
+    '''
+    Convert a compression option to the numerical ROOT compression setting.
+    Accepted are None, integers like 404, algorithm names like 'lz4'
+    and algorithm names with a level like 'lzma-9'
+    '''
+    if value is None or isinstance(value, int):
+        return value
+    value = str(value).strip().lower()
+    if value.isdigit():
+        return int(value)
+    name, _, level = value.partition('-')
+    if name not in COMPRESSION_ALGORITHMS:
+        raise ValueError("Unknown compression algorithm '%s'" % name)
+    if not level:
+        return COMPRESSION_ALGORITHMS[name]
+    if not level.isdigit() or not 0 <= int(level) <= 9:
+        raise ValueError("Invalid compression level '%s'" % level)
+    if not COMPRESSION_ALGORITHMS[name]:
+        return 0
+    return COMPRESSION_ALGORITHMS[name] - COMPRESSION_ALGORITHMS[name] % 100 + int(level)
 
 def write_current_info(filename, string):
     try:
@@ -216,26 +265,43 @@ def write_current_info(filename, string):
         raise
 
 
-def check_goat():
+def check_goat(goat_bin=GOAT_BIN, goat_config=GOAT_CONFIG):
     if not check_path(GOAT_PATH):
         print("        Please make sure your goat directory can be found at the given path.")
         return False
-    goat_bin = get_path(GOAT_BUILD, 'bin')
-    if not check_file(goat_bin, GOAT_BIN):
-        print("        Could not find the specified executable '%s'." % GOAT_BIN)
+    bin_path = get_path(GOAT_BUILD, 'bin')
+    if not check_file(bin_path, goat_bin):
+        print("        Could not find the specified executable '%s'." % goat_bin)
         print("        Please make sure the defined executable is correct.")
         return False
-    bin = get_path(goat_bin, GOAT_BIN)
-    if GOAT_CONFIG == '/dev/null':
+    bin = get_path(bin_path, goat_bin)
+    if goat_config == '/dev/null':
         config = '/dev/null'
-    elif not check_file(GOAT_PATH, GOAT_CONFIG):
+    elif not check_file(GOAT_PATH, goat_config):
         print("        Could not find your specified goat config file.")
         return False
     else:
-        config = get_path(GOAT_PATH, GOAT_CONFIG)
+        config = get_path(GOAT_PATH, goat_config)
     return bin, config
 
-def goat_analysis(files, goat_bin, goat_config, output_directory=None, prefix='Analysis', sim_log=None, verbose=False):
+def parse_variant(variant):
+    '''
+    Split a sweep variant of the form [name=]binary[:config] into its name,
+    binary and config; the name is built from binary and config if omitted
+    '''
+    name, sep, spec = variant.partition('=')
+    if not sep:
+        name, spec = '', name
+    goat_bin, _, goat_config = spec.partition(':')
+    if not goat_config:
+        goat_config = GOAT_CONFIG
+    if not name:
+        name = goat_bin
+        if goat_config != '/dev/null':
+            name += '_' + os.path.splitext(os.path.basename(goat_config))[0]
+    return name, goat_bin, goat_config
+
+def goat_analysis(files, goat_bin, goat_config, output_directory=None, prefix='Analysis', sim_log=None, stager=None, progress=None, verbose=False):
     output_channels = {}
     if verbose:
         print_color('\n - - - Starting GoAT analysis with ant - - - \n', RED)
@@ -245,6 +311,11 @@ def goat_analysis(files, goat_bin, goat_config, output_directory=None, prefix='A
     if not log_output_path:  # if no output_directory is given, the path of the first file will be used for the log file
         log_output_path = os.path.split(get_all_dict_values(files)[0])[0]
 
+    if stager:
+        stager.schedule(get_all_dict_values(files))
+    if progress:
+        progress.add('analysis', dict((channel, len(input_files)) for channel, input_files in files.items()))
+
     with open(get_path(log_output_path, 'goat.log'), 'w') as log:
         for channel, input_files in files.items():
             output_channels.update({channel: []})
@@ -264,8 +335,8 @@ def goat_analysis(files, goat_bin, goat_config, output_directory=None, prefix='A
                         output_file = get_path(output_directory, 'Analysis_' + filename)
                 else:
                     output_file = input_file.replace(prefix, OUTPUT_FILE_PREFIX)
-                    if not path in output_directory:
-                        output_file = get_path(output_directory, filename)
+                    if output_directory:
+                        output_file = get_path(output_directory, os.path.basename(output_file))
                 filename = input_file
                 if not verbose:
                     filename = os.path.basename(filename)
@@ -273,15 +344,27 @@ def goat_analysis(files, goat_bin, goat_config, output_directory=None, prefix='A
                 if sim_log:
                     sim_log.write(timestamp() + 'Analysing file %s\n' % input_file)
                     sim_log.flush()
-                cmd = ' '.join([goat_bin, goat_config, input_file, output_file])
+                if progress:
+                    progress.job_started(os.path.basename(input_file))
+                job_input, job_output = input_file, output_file
+                if stager:
+                    job_input = stager.fetch(input_file)
+                    job_output = stager.local_output(output_file, input_file)
+                cmd = ' '.join([goat_bin, goat_config, job_input, job_output])
                 # use -b for batchmode (no graphical output) and -q to exit after processing files
                 # print errors to log file due to error outputs like "Info in <PStdData::PStdData()>: (CONSTRUCTOR)" because of Pluto
                 ret = run(cmd + ' -b -q', log, True)
+                if stager:
+                    stager.release(input_file)
+                    if not stager.commit(job_output, output_file):
+                        logger.error('No output file %s has been produced' % os.path.basename(output_file))
                 if ret:
                     logger.critical('Non-zero return code (%d), something might have gone wrong' % ret)
                     if sim_log:
                         sim_log.write(timestamp() + 'Non-zero return code (%d), something might have gone wrong\n' % ret)
                         sim_log.flush()
+                if progress:
+                    progress.job_done(channel, os.path.basename(input_file), file_size(input_file))
                 output_channels[channel].append(output_file)
 
     if verbose:
@@ -291,7 +374,7 @@ def goat_analysis(files, goat_bin, goat_config, output_directory=None, prefix='A
 
     return output_channels
 
-def merge_files(files, output_directory=None, prefix='Merged', sim_log=None, force=False, verbose=False):
+def merge_files(files, output_directory=None, prefix='Merged', sim_log=None, force=False, compression=None, objects=None, skip_trees=False, stager=None, index=None, intermediate='keep', archive_directory=None, progress=None, verbose=False):
     merged_files = []
     if verbose:
         print_color('\n - - - Start merging root files - - - \n', RED)
@@ -301,6 +384,9 @@ def merge_files(files, output_directory=None, prefix='Merged', sim_log=None, for
     if not log_output_path:  # if no output_directory is given, the path of the first file will be used for the log file
         log_output_path = os.path.split(get_all_dict_values(files)[0])[0]
 
+    if progress:
+        progress.add('merge', dict((channel, len(input_files)) for channel, input_files in files.items()))
+
     with open(get_path(log_output_path, 'hadd.log'), 'w') as log:
         for channel, input_files in files.items():
             merged = prefix + '_' + channel + '_merged.root'
@@ -314,18 +400,70 @@ def merge_files(files, output_directory=None, prefix='Merged', sim_log=None, for
             else:
                 merged = get_path(log_output_path, merged)
 
-            if force:
+            # hadd only accepts a compression setting together with -f, the native merger and
+            # staged outputs overwrite existing files, so check for them ourselves if force is not set
+            if not force and (objects or compression is not None or stager) and os.path.isfile(merged):
+                logger.critical('The file %s already exists, use --force to overwrite it' % merged)
+                if sim_log:
+                    sim_log.write(timestamp() + 'The file %s already exists, skip merging\n' % merged)
+                    sim_log.flush()
+                merged_files.append(merged)
+                if progress:
+                    progress.job_done(channel, files=len(input_files))
+                continue
+            input_bytes = 0
+            if progress:
+                progress.job_started(os.path.basename(merged))
+                input_bytes = sum(file_size(f) for f in input_files)
+            if objects:
+                # only merge the requested objects natively instead of using hadd
+                if stager:
+                    ret = merge_objects(input_files, stager.partial_output(merged), objects, compression)
+                    if not ret:
+                        stager.commit(stager.partial_output(merged), merged)
+                else:
+                    ret = merge_objects(input_files, merged, objects, compression)
+                if ret:
+                    logger.critical('None of the requested objects could be merged for channel %s' % format_channel(channel, False))
+                    if sim_log:
+                        sim_log.write(timestamp() + 'None of the requested objects could be merged\n')
+                        sim_log.flush()
+                merged_files.append(merged)
+                if progress:
+                    progress.job_done(channel, os.path.basename(merged), input_bytes, len(input_files))
+                continue
+            if compression is not None:
+                cmd = 'hadd -f%d ' % compression
+            elif force:
                 cmd = 'hadd -f '
             else:
                 cmd = 'hadd '
-            cmd += merged + ' ' + ' '.join(input_files)
+            if skip_trees:
+                cmd += '-T '
+            # the merged file is about as large as all inputs of the channel, so it isn't written to the
+            # scratch directory but next to its destination and renamed once it's complete
+            job_output = merged
+            if stager:
+                job_output = stager.partial_output(merged)
+            cmd += job_output + ' ' + ' '.join(input_files)
             ret = run(cmd, log, True)  # print errors to the log file because of missing PParticle dictionary
+            if stager and not stager.commit(job_output, merged):
+                logger.error('No merged file %s has been produced' % os.path.basename(merged))
             if ret:
                 logger.critical('Non-zero return code (%d), something might have gone wrong' % ret)
                 if sim_log:
                     sim_log.write(timestamp() + 'Non-zero return code (%d), something might have gone wrong\n' % ret)
                     sim_log.flush()
+            elif index and not skip_trees:
+                # the entries of the merged file are the sum of the inputs, no need to open it later on
+                counts = [index.get(f, 'entries') for f in input_files]
+                if None not in counts:
+                    index.update(merged, entries=sum_entries(counts))
+            if not ret and intermediate != 'keep':
+                cleanup_intermediate(input_files, merged, intermediate, archive_directory)
             merged_files.append(merged)
+            if progress:
+                progress.job_done(channel, os.path.basename(merged), input_bytes, len(input_files))
 
     if verbose:
         print_color('\nFinished merging files\n', RED)
@@ -334,6 +472,111 @@ def merge_files(files, output_directory=None, prefix='Merged', sim_log=None, for
 
     return merged_files
 
+def cleanup_intermediate(files, merged, policy, archive_directory=None):
+    '''
+    Delete or archive the files which have been merged into the given file,
+    nothing is done unless the merged file passes the pre-flight check
+    '''
+    reason = check_root_file(merged)
+    if reason:
+        logger.warning('The merged file %s failed the check (%s), will keep the single files' % (os.path.basename(merged), reason))
+        return False
+    if policy == 'archive':
+        check_path(archive_directory, create=True, silent=True)
+    for filename in files:
+        if not os.path.isfile(filename):
+            continue
+        if policy == 'archive':
+            move(filename, get_path(archive_directory, os.path.basename(filename)))
+        else:
+            os.remove(filename)
+    logger.debug('%s %d single files of %s' % ('Archived' if policy == 'archive' else 'Deleted', len(files), os.path.basename(merged)))
+    return True
+
+def prune_archives(directory, keep):
+    '''
+    Remove all but the newest keep runs in the archive directory,
+    the runs are stored in subdirectories named by their time stamp
+    '''
+    if not os.path.isdir(directory):
+        return
+    runs = sorted(d for d in os.listdir(directory) if os.path.isdir(pjoin(directory, d)))
+    for run in runs[:max(len(runs) - keep, 0)]:
+        logger.debug('Remove archived run %s' % run)
+        rmtree(pjoin(directory, run))
+
+def sweep_analysis(files, variants, output_directory, prefix='Analysis', sim_log=None, merge_analysis=False, jobs=None, progress=None, verbose=False, **merge_options):
+    '''
+    Analyse the same files with several (name, binary, config) variants concurrently,
+    the output of every variant is stored in its own subdirectory of output_directory;
+    returns a dict with the output channels of every variant
+    '''
+
+    def analyse_variant(name, goat_bin, goat_config):
+        variant_directory = get_path(output_directory, name)
+        check_path(variant_directory, create=True, silent=True)
+        logger.info('Start analysis of variant %s' % name)
+        output_channels = goat_analysis(files, goat_bin, goat_config, variant_directory, prefix=prefix, sim_log=sim_log, progress=progress, verbose=verbose)
+        if merge_analysis:
+            options = dict(merge_options)
+            # the single files of all variants have the same names, archive them separately
+            if options.get('archive_directory'):
+                options.update(archive_directory=get_path(options['archive_directory'], name))
+            # the analyses of the other variants may still be running, so the merging isn't reported as a separate stage
+            merged_files = merge_files(output_channels, variant_directory, prefix=OUTPUT_FILE_PREFIX, sim_log=sim_log, verbose=verbose, **options)
+            output_channels = sort_channels(merged_files, '^' + OUTPUT_FILE_PREFIX + '_(.+)_merged.root$')
+        logger.info('Finished analysis of variant %s' % name)
+        return output_channels
+
+    with ThreadPoolExecutor(max_workers=jobs or len(variants)) as executor:
+        futures = dict((name, executor.submit(analyse_variant, name, goat_bin, goat_config)) for name, goat_bin, goat_config in variants)
+        return dict((name, future.result()) for name, future in futures.items())
+
+def merge_objects(files, merged, objects, compression=None):
+    from ROOT import TFile
+    merged_objects = {}
+    skipped = set()
+    for filename in files:
+        current = TFile(filename)
+        if not current.IsOpen():
+            logger.error('The file %s could not be opened, will skip it' % filename)
+            continue
+        file_entries = get_root_entries(current)
+        for name in objects:
+            entry = [e for e in file_entries if e.rsplit('/', 1)[-1] == name]
+            if not entry:
+                continue
+            obj = current.Get(entry[0])
+            if obj == None:  # explicit check needed for pyROOT null pointers
+                continue
+            # only histograms can be added up and detached from the file
+            if not obj.InheritsFrom('TH1'):
+                if name not in skipped:
+                    logger.warning('%s is a %s and no histogram, it will not be merged' % (name, obj.IsA().GetName()))
+                    skipped.add(name)
+                continue
+            if name in merged_objects:
+                if not merged_objects[name].Add(obj):
+                    logger.error('Error adding %s of file %s' % (name, filename))
+            else:
+                merged_objects[name] = copy(obj)
+                merged_objects[name].SetDirectory(0)  # detach it that it won't get deleted after closing the file
+        current.Close()
+
+    if not merged_objects:
+        return 1
+
+    if compression is None:
+        out = TFile(merged, 'RECREATE')
+    else:
+        out = TFile(merged, 'RECREATE', '', compression)
+    out.cd()
+    for name, obj in merged_objects.items():
+        obj.Write(name)
+    out.Close()
+
+    return 0
+
 def is_valid_file(parser, arg):
     if not os.path.isfile(arg):
         parser.error('The file %s does not exist!' % arg)
@@ -346,6 +589,30 @@ def is_valid_dir(parser, arg):
     else:
         return os.path.expanduser(arg)
 
+def is_valid_sample(parser, arg):
+    try:
+        if arg.endswith('%'):
+            sample = float(arg[:-1])/100
+        elif '.' in arg:
+            sample = float(arg)
+        else:
+            sample = int(arg)
+    except ValueError:
+        parser.error('The sample %s is neither a fraction nor a number of files!' % arg)
+    if sample <= 0 or isinstance(sample, float) and sample > 1:
+        parser.error('The sample %s has to be a number of files or a fraction between 0 and 1!' % arg)
+    return sample
+
+def is_valid_keep_runs(parser, arg):
+    if not arg.isdigit() or int(arg) < 1:
+        parser.error('The number of runs to keep has to be at least 1, but %s was given!' % arg)
+    return int(arg)
+
+def is_valid_jobs(parser, arg):
+    if not arg.isdigit() or int(arg) < 1:
+        parser.error('The number of jobs has to be at least 1, but %s was given!' % arg)
+    return int(arg)
+
 def sort_channels(file_list, pattern):
     sorted_channels = {}
     regex = re.compile(pattern)
@@ -362,6 +629,26 @@ def sort_channels(file_list, pattern):
             sorted_channels['misc'].append(filename)
     return sorted_channels
 
+def sample_channels(channels, sample, seed=0):
+    '''
+    Select a reproducible subset of the files of every channel, sample is either
+    a fraction (float) or a number of files per channel; returns the sampled
+    channels and the factors to scale them to the full statistics
+    '''
+    sampled_channels = {}
+    scale_factors = {}
+    for channel, lst in channels.items():
+        if isinstance(sample, float):
+            n = max(1, int(round(len(lst)*sample)))
+        else:
+            n = min(sample, len(lst))
+        # rank the files by a hash of their name, this way the selection doesn't
+        # depend on the order of the list and stays stable if files are added
+        ranked = sorted(lst, key=lambda f: md5(('%s:%s' % (seed, os.path.basename(f))).encode()).hexdigest())
+        sampled_channels.update({channel: sorted(ranked[:n])})
+        scale_factors.update({channel: len(lst)/n})
+    return sampled_channels, scale_factors
+
 def merge_histograms(lst):
     if not lst:
         print_error('Passed empty list!')
@@ -446,6 +733,61 @@ def get_root_entries(directory):
             entries.append(dir_name + key.GetName())
     return entries
 
+def get_tree_entries(root_file):
+    entries = {}
+    for key in root_file.GetListOfKeys():
+        if key.GetClassName() == 'TTree':
+            # the tree object with its branch and basket metadata is read, but not the baskets themselves
+            entries.update({key.GetName(): int(root_file.Get(key.GetName()).GetEntries())})
+    return entries
+
+def sum_entries(counts):
+    entries = {}
+    for count in counts:
+        for tree, n in count.items():
+            entries[tree] = entries.get(tree, 0) + n
+    return entries
+
+def count_events(files, index):
+    '''
+    Sum up the tree entries of the given files, the entries are taken
+    from the index if possible, otherwise the trees are read from the files
+    '''
+    from ROOT import TFile
+    events = {}
+    for filename in files:
+        entries = index.get(filename, 'entries')
+        if entries is None:
+            current = TFile(filename)
+            if not current.IsOpen():
+                logger.error('The file %s could not be opened to count the events' % filename)
+                continue
+            entries = get_tree_entries(current)
+            current.Close()
+            index.update(filename, entries=entries)
+        for tree, n in entries.items():
+            events[tree] = events.get(tree, 0) + n
+    return events
+
+def setup_root():
+    if ROOTSYS and ROOTSYS + '/lib' not in sys.path:
+        #os.environ['ROOTSYS'] = ROOTSYS
+        #os.environ['PYTHONPATH'] = ROOTSYS + '/lib:' + os.environ['PYTHONPATH']
+        # The Python interpreter is already running, so we can't just simply
+        # set environment variables via os.environ['VARABLE_NAME']. Instead
+        # we have to append them to the path which Python actually uses to
+        # search for packages
+        #sys.path.append(ROOTSYS + '/lib')
+        # use insert instead of append to add the entry at the beginnging of
+        # the list to be sure it is used prioritised
+        sys.path.insert(0, ROOTSYS + '/lib')
+        logger.debug('Added custom ROOTSYS to import ROOT package')
+    #print(os.environ['ROOTSYS'])
+    #print(os.environ['PYTHONPATH'])
+    #print(sys.path)
+    #ROOT = ROOTSYS + '/lib/ROOT.py'
+    #ROOT = __import__(ROOT)
+
 def main():
     #sys.argv
 
@@ -467,6 +809,8 @@ def main():
             help='merge (join) single analysed files for each channel into one file')
     parser.add_argument('-p', '--plot', nargs='+', metavar='histogram name',
             help='the name of the histogram(s) which should be plotted for each file')
+    parser.add_argument('--merge-mode', choices=['all', 'histograms', 'selected'], default='all',
+            help='objects which should be merged for plotting: all objects (hadd default), only histograms (skip TTrees) or only the histograms selected with -p (default: %(default)s)')
     parser.add_argument('-f', '--force', action='store_true',
             help='force recreation of files if they already exist (applies mainly for merging files)')
     parser.add_argument('-l', '--log-option', nargs='+', metavar='logarithmic option',
@@ -475,7 +819,43 @@ def main():
             help='ROOT drawing style for histograms (for example colz)')
     parser.add_argument('-r', '--root-output', nargs=1, metavar='ROOT output filename',
             help='store the produced histograms in a root file with the given name')
+    parser.add_argument('-c', '--compression', nargs='+', metavar='compression option',
+            help='ROOT compression for merged files, use the following format: stage:setting with stage = intermediate or final and setting = none, zlib, lzma, lz4, zstd (optionally with a level, e. g. lzma-9) or a numerical ROOT setting; e. g. -c intermediate:lz4 final:zstd')
+    parser.add_argument('--stage', nargs=1, metavar='directory',
+            help='local scratch directory; input files will be prefetched there and outputs are written there before being moved to the output directory')
+    parser.add_argument('--prefetch', type=int, default=2, metavar='K',
+            help='number of input files which are staged ahead of the running job (default: %(default)d)')
+    parser.add_argument('--scratch-quota', metavar='size',
+            type=parse_size,
+            help='maximum space used on the scratch directory by staged input files and the space reserved for their outputs (as large as the input), e. g. 20G; unlimited if not specified')
+    parser.add_argument('--log-file', nargs=1, metavar='file',
+            help='write a log of the processed files with time stamps to the given file')
+    parser.add_argument('--json-log', nargs=1, metavar='file',
+            help='write all logging output additionally as JSON lines to the given file')
+    parser.add_argument('--sweep', nargs='+', metavar='[name=]binary[:config]',
+            help='analyse the files with several GoAT binaries and / or config files concurrently, the output of each variant is stored in its own subdirectory; the config defaults to GOAT_CONFIG')
+    parser.add_argument('--jobs', metavar='N',
+            type=lambda x: is_valid_jobs(parser, x),
+            help='maximum number of concurrent analyses of a sweep (default: one per sweep variant) and of threads checking the files with --preflight (default: four per CPU, at most 32)')
+    parser.add_argument('--sample', metavar='fraction or number',
+            type=lambda x: is_valid_sample(parser, x),
+            help='only process a reproducible subset of the files of every channel, either a fraction (e. g. 0.05 or 5%%) or a number of files; the outputs are stored in the subdirectory sample_<value>_<seed> of the output directory and the plots are annotated with the factor to scale to the full statistics')
+    parser.add_argument('--sample-seed', type=int, default=0, metavar='seed',
+            help='seed to choose a different subset of files with --sample (default: %(default)d)')
+    parser.add_argument('-n', '--normalise', action='store_true',
+            help='normalise the histograms of every channel to its number of events, the event counts are cached in the output directory')
+    parser.add_argument('--preflight', action='store_true',
+            help='check the headers, sizes and number of keys of all input files in parallel before any job is started; bad files are skipped and listed in quarantine.txt in the output directory')
+    parser.add_argument('--quarantine', nargs=1, metavar='directory',
+            help='move input files which fail the pre-flight check to the given directory (implies --preflight)')
+    parser.add_argument('--intermediate', choices=['keep', 'delete', 'archive'], default='keep',
+            help='what happens to the single analysed files once the merged file of their channel (-j) has been verified (default: %(default)s)')
+    parser.add_argument('--keep-runs', metavar='N',
+            type=lambda x: is_valid_keep_runs(parser, x),
+            help='only keep the archived single files of the last N runs')
     # possible options: s -> skip analysis, only plot stuff; l -> list possible histograms from file
+    parser.add_argument('--progress', action='store_true',
+            help='show the progress with throughput and ETA; a single updated line on a terminal, JSON status lines otherwise')
     parser.add_argument('-v', '--verbose', action='store_true',
             help='print logging output to the terminal')
     #parser.add_argument()
@@ -487,17 +867,41 @@ def main():
     root_output = None
     style = ''
     log1d, log2d, log3d = '', '', ''
+    compression_intermediate = compression_setting(COMPRESSION_INTERMEDIATE)
+    compression_final = compression_setting(COMPRESSION_FINAL)
     merge = args.merge
     analyse = args.analyse
     merge_analysis = args.merge_analysis
     plots = args.plot
     force = args.force
+    merge_mode = args.merge_mode
+    normalise = args.normalise
+    intermediate = args.intermediate
+    archive_directory = None
+    stager = None
+    variants = []
     verbose = args.verbose
     # adapt logger level to verbose statement
     if verbose:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
+    if args.json_log:
+        logger.addHandler(JsonLinesHandler(args.json_log[0]))
+    progress = None
+    if args.progress:
+        progress = Progress()
+    if progress and progress.tty:
+        for handler in list(logger.handlers):
+            # only the handlers which write to the same stream as the progress display
+            if isinstance(handler, logging.StreamHandler) and handler.stream is progress.stream:
+                logger.removeHandler(handler)
+                logger.addHandler(ProgressHandler(handler, progress))
+    # format and write the logging output in a background thread
+    enable_async_logging(logger)
+    sim_log = None
+    if args.log_file:
+        sim_log = AsyncLogFile(args.log_file[0])
     if args.filename:
         input_file_list = args.filename[0]
     if args.dir:
@@ -511,6 +915,14 @@ def main():
             sys.exit("        Please make sure the specified input directory INPUT_DATA_PATH exists.")
         else:
             input_dir = get_path(INPUT_DATA_PATH)
+    if args.sweep:
+        variants = [parse_variant(variant) for variant in args.sweep]
+        if len(set(name for name, _, _ in variants)) != len(variants):
+            logger.error('The names of the sweep variants have to be unique')
+            sys.exit(1)
+        if not analyse:
+            logger.info('You specified a sweep, the files will be analysed with every variant.')
+            analyse = True
     if merge_analysis and not analyse:
         logger.warning("You specified to merge the analyse files but haven't specified to analyse the files.")
         logger.warning("Will assume that the files should be analysed as well.")
@@ -525,6 +937,7 @@ def main():
         else:
             output = get_path(OUTPUT_DATA_PATH)
             logger.debug("Use directory '%s' to store the output data" % output)
+    index = FileIndex(get_path(output, INDEX_FILE))
     if args.root_output:
         root_output = args.root_output[0]
     if args.style:
@@ -552,6 +965,32 @@ def main():
                 logger.debug('Use logarithmic %s axes for 3D histograms.' % ', '.join(log3d))
             else:
                 logger.warning("Unknown log-option '%s', will be skipped." % opt)
+    if args.compression:
+        for opt in args.compression:
+            stage, _, setting = opt.lower().partition(':')
+            try:
+                setting = compression_setting(setting)
+            except ValueError as e:
+                logger.warning("%s, compression option '%s' will be skipped." % (e, opt))
+                continue
+            if stage == 'intermediate':
+                compression_intermediate = setting
+                logger.debug('Use compression setting %d for intermediate files.' % setting)
+            elif stage == 'final':
+                compression_final = setting
+                logger.debug('Use compression setting %d for final files.' % setting)
+            else:
+                logger.warning("Unknown compression stage '%s', will be skipped." % stage)
+    if args.stage:
+        if not check_path(args.stage[0], create=True):
+            sys.exit('        Please make sure the specified scratch directory can be created.')
+        stager = Stager(args.stage[0], args.prefetch, args.scratch_quota or 0)
+        logger.debug("Use directory '%s' to stage files" % stager.directory)
+        if variants:
+            logger.warning('Staging is not used for the concurrent analyses of a sweep, only for merging the input files.')
+    if merge_mode == 'selected' and not plots:
+        logger.warning('Merging only the selected histograms needs histograms specified via -p, will merge all objects.')
+        merge_mode = 'all'
     if merge and merge_analysis:
         logger.info('You specified both merge and merge_analysis.')
         logger.info('Will skip merge_analysis as the files will be already merged before')
@@ -564,7 +1003,7 @@ def main():
         logger.debug("Use directory '%s' to read in files" % input_dir)
 
     if input_dir:
-        input_files = [filename for filename in os.listdir(input_dir) if filename.endswith('.root')]
+        input_files = [pjoin(input_dir, filename) for filename in os.listdir(input_dir) if filename.endswith('.root')]
         #TODO: new in Python 3.5: os.scandir() (faster) https://docs.python.org/dev/library/os.html#os.scandir
     elif input_file_list:
         input_files = []
@@ -596,6 +1035,29 @@ def main():
         logger.error("Neither input-directory nor input-file-list exists. This shouldn't happen.")
         sys.exit(1)
 
+    if args.preflight or args.quarantine:
+        logger.info('Checking %d input files' % len(input_files))
+        bad_files = preflight(input_files, index, MIN_FILE_SIZE, args.jobs, progress)
+        if progress:
+            progress.finish()
+        if bad_files:
+            logger.warning('%d input files failed the pre-flight check and will be skipped:' % len(bad_files))
+            for filename, reason in sorted(bad_files.items()):
+                logger.warning('   %s: %s' % (os.path.basename(filename), reason))
+            quarantine_directory = None
+            if args.quarantine:
+                quarantine_directory = args.quarantine[0]
+                if not check_path(quarantine_directory, create=True):
+                    sys.exit('        Please make sure the quarantine directory can be created.')
+                quarantine_directory = get_path(quarantine_directory)
+            quarantine_files(bad_files, get_path(output, 'quarantine.txt'), quarantine_directory)
+            input_files = [filename for filename in input_files if filename not in bad_files]
+            if not input_files:
+                logger.error('No valid input files left, will terminate.')
+                index.save()
+                sys.exit(1)
+        index.save()
+
     output_files = []
     channels = []
     input_channels = {}
@@ -629,53 +1091,110 @@ def main():
         if verbose:
             for f in lst:
                 logger.debug('   ' + f)
+    scale_factors = {}
+    if args.sample:
+        input_channels, scale_factors = sample_channels(input_channels, args.sample, args.sample_seed)
+        input_files = get_all_dict_values(input_channels)
+        logger.info('Use a sample of the files for a quick preview:')
+        for chan, lst in input_channels.items():
+            try:
+                name = format_channel(chan, False)
+            except:
+                name = chan
+            logger.info('   {0:15s} ({1:d} files, scale factor {2:.4g})'.format(name, len(lst), scale_factors[chan]))
+        # keep the outputs of a sample apart from the ones of the full statistics
+        index.save()
+        output = get_path(output, 'sample_%s_%d' % (args.sample, args.sample_seed))
+        if not check_path(output, create=True, silent=True):
+            sys.exit('        Please make sure the output directory for the sample can be created.')
+        logger.info("The outputs of the sample will be stored in '%s'" % output)
+        index = FileIndex(get_path(output, INDEX_FILE))
+    # keep the input files of every channel for the normalisation
+    source_channels = input_channels
+    merged_inputs = {}
+    # objects which should be merged if the merged files are only used for plotting
+    plot_objects = None
+    if merge_mode == 'selected':
+        setup_root()
+        plot_objects = plots
+    skip_trees = merge_mode == 'histograms'
+    if intermediate != 'keep' and (plot_objects or skip_trees):
+        logger.warning('The merged files will not contain all objects, the single analysed files will be kept.')
+        intermediate = 'keep'
+    if intermediate == 'archive':
+        archive_directory = get_path(output, pjoin('archive', datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')))
+
     if merge:
         prefix = 'Goat'
         if prefix is INPUT_FILE_PREFIX:
             prefix += '_'
-        merged_files = merge_files(input_channels, output, prefix=prefix, force=force, verbose=verbose)
+        # the analysis needs the full files, only restrict merging if the merged files are plotted directly
+        if analyse:
+            merged_files = merge_files(input_channels, output, prefix=prefix, force=force, compression=compression_intermediate, sim_log=sim_log, stager=stager, index=index, progress=progress, verbose=verbose)
+        else:
+            merged_files = merge_files(input_channels, output, prefix=prefix, force=force, compression=compression_intermediate,
+                    objects=plot_objects, skip_trees=skip_trees, sim_log=sim_log, stager=stager, index=index, progress=progress, verbose=verbose)
+        merged_inputs = sort_channels(merged_files, '^' + prefix + '_(.+)_merged.root$')
 
     if analyse:
-        check = check_goat()
-        if not check:
-            sys.exit(1)
-        goat_bin, goat_config = check
+        if variants:
+            checked_variants = []
+            for name, goat_bin, goat_config in variants:
+                check = check_goat(goat_bin, goat_config)
+                if not check:
+                    sys.exit(1)
+                checked_variants.append((name,) + check)
+        else:
+            check = check_goat()
+            if not check:
+                sys.exit(1)
+            goat_bin, goat_config = check
 
         if merge:
             input_files = merged_files
             pattern = '^' + prefix + '_(.+)_merged.root$'
             input_channels = sort_channels(merged_files, pattern)
-        output_channels = goat_analysis(input_channels, goat_bin, goat_config, output, prefix=prefix, verbose=verbose)
+        if variants:
+            sweep_channels = sweep_analysis(input_channels, checked_variants, output, prefix=prefix, sim_log=sim_log,
+                    merge_analysis=merge_analysis, jobs=args.jobs, progress=progress, verbose=verbose,
+                    force=force, compression=compression_final, objects=plot_objects, skip_trees=skip_trees, index=index,
+                    intermediate=intermediate, archive_directory=archive_directory)
+            # combine the channels of all variants for a single plotting pass
+            output_channels = {}
+            for name, channels in sweep_channels.items():
+                for channel, lst in channels.items():
+                    output_channels.update({'[%s] %s' % (name, channel): lst})
+        else:
+            output_channels = goat_analysis(input_channels, goat_bin, goat_config, output, prefix=prefix, sim_log=sim_log, stager=stager, progress=progress, verbose=verbose)
 
-        if merge_analysis:
-            output_channels = merge_files(output_channels, output, prefix=OUTPUT_FILE_PREFIX, force=force, verbose=verbose)
+        if merge_analysis and not variants:
+            merged_files = merge_files(output_channels, output, prefix=OUTPUT_FILE_PREFIX, force=force, compression=compression_final,
+                    objects=plot_objects, skip_trees=skip_trees, sim_log=sim_log, stager=stager, index=index,
+                    intermediate=intermediate, archive_directory=archive_directory, progress=progress, verbose=verbose)
+            output_channels = sort_channels(merged_files, '^' + OUTPUT_FILE_PREFIX + '_(.+)_merged.root$')
     # in case no analysis is performed, prepare the dict output_channels for the case of merged files or the raw input files
     elif not analyse and merge:
         output_channels = sort_channels(merged_files, '^' + prefix + '_(.+)_merged.root$')
     else:
         output_channels = sort_channels(input_files, pattern)
 
+    if args.keep_runs is not None:
+        prune_archives(get_path(output, 'archive'), args.keep_runs)
+
+    # all jobs are done, remove the staged files
+    if progress:
+        progress.finish()
+    if stager:
+        stager.close()
+    if sim_log:
+        sim_log.close()
+
     # terminate at this point if no plots should be created
     if not plots:
+        index.save()
         sys.exit(0)
 
-    if ROOTSYS:
-        #os.environ['ROOTSYS'] = ROOTSYS
-        #os.environ['PYTHONPATH'] = ROOTSYS + '/lib:' + os.environ['PYTHONPATH']
-        # The Python interpreter is already running, so we can't just simply
-        # set environment variables via os.environ['VARABLE_NAME']. Instead
-        # we have to append them to the path which Python actually uses to
-        # search for packages
-        #sys.path.append(ROOTSYS + '/lib')
-        # use insert instead of append to add the entry at the beginnging of
-        # the list to be sure it is used prioritised
-        sys.path.insert(0, ROOTSYS + '/lib')
-        logger.debug('Added custom ROOTSYS to import ROOT package')
-    #print(os.environ['ROOTSYS'])
-    #print(os.environ['PYTHONPATH'])
-    #print(sys.path)
-    #ROOT = ROOTSYS + '/lib/ROOT.py'
-    #ROOT = __import__(ROOT)
+    setup_root()
     from ROOT import gROOT, gStyle, gPad#, gDirectory
     from ROOT import TFile, TDirectoryFile
     from ROOT import TCanvas, TH1, TLegend
@@ -686,17 +1205,31 @@ def main():
     #gPad.SetLogz()
     histograms = {}
 
+    # only the entries of the files which are used for the normalisation are of interest
+    normalised_files = set()
+    if normalise:
+        normalised_files = set(get_all_dict_values(source_channels) + get_all_dict_values(merged_inputs))
     logger.info('Start reading in the file contents to gather the histograms')
+    if progress:
+        progress.add('harvest', dict((channel, len(file_list)) for channel, file_list in output_channels.items()))
     for channel, file_list in output_channels.items():
         for filename in file_list:
+            if progress:
+                progress.job_started(os.path.basename(filename))
             current = TFile(filename)
             if not current.IsOpen():  # only proceed if the file exists and is opened
                 logger.error('The file could not be opened, please make sure it exists and is readable')
+                if progress:
+                    progress.job_done(channel, os.path.basename(filename))
                 continue
             if not current.GetListOfKeys().GetSize():
                 logger.critical('The file %s is empty' % current.GetName())
                 logger.critical('Will skip this file')
+                if progress:
+                    progress.job_done(channel, os.path.basename(filename), file_size(filename))
                 continue
+            if filename in normalised_files and index.get(filename, 'entries') is None:
+                index.update(filename, entries=get_tree_entries(current))
             #dirs = [d.GetName() for d in current.GetListOfKeys() if d.GetClassName() == 'TDirectoryFile']
             file_entries = get_root_entries(current)
             if verbose:
@@ -725,6 +1258,30 @@ def main():
                     continue
                 histograms[plot][channel].append(copy(hist))
             current.Close()
+            if progress:
+                progress.job_done(channel, os.path.basename(filename), file_size(filename))
+    if progress:
+        progress.finish()
+
+    # the entries have been gathered while merging and reading in the histograms,
+    # only the headers of input files which haven't been seen yet have to be read
+    events = {}
+    if normalise:
+        logger.info('Count the events of every channel for the normalisation')
+        for channel, file_list in source_channels.items():
+            # the merged input file contains the same events as the single files of its channel
+            cached = [index.get(f, 'entries') for f in merged_inputs.get(channel, [])]
+            if cached and all(cached):
+                counts = sum_entries(cached)
+            else:
+                counts = count_events(file_list, index)
+            if NORMALISATION_TREE:
+                events.update({channel: counts.get(NORMALISATION_TREE, 0)})
+            else:
+                events.update({channel: max(counts.values()) if counts else 0})
+            logger.debug('Found %d events for channel %s' % (events[channel], channel))
+    # store the event counts before creating the plots
+    index.save()
 
     if not get_all_dict_values(histograms):
         logger.error('No specified histograms found, will terminate')
@@ -752,20 +1309,35 @@ def main():
                 logger.critical('No %s histograms found for channel %s' % (plot, channel))
                 histograms[plot][channel] = None
 
+    if normalise:
+        for plot, channels in histograms.items():
+            for channel, hist in channels.items():
+                # channels of a sweep are prefixed with the variant name
+                n = events.get(channel.rsplit('] ', 1)[-1])
+                if not hist:
+                    continue
+                elif not n:
+                    logger.warning('No events found for channel %s, the %s histogram will not be normalised' % (channel, plot))
+                else:
+                    hist.Scale(1./n)
+
     root_out = None
     if root_output:
-        root_out = TFile(get_path(output, root_output), 'RECREATE')
+        if compression_final is None:
+            root_out = TFile(get_path(output, root_output), 'RECREATE')
+        else:
+            root_out = TFile(get_path(output, root_output), 'RECREATE', '', compression_final)
 
     logger.info('Create the plots with the desired histograms')
     for name, hists in histograms.items():
         cols, rows = get_dimensions(len(hists))
         canvas = TCanvas(name)
         canvas.Divide(cols, rows)
-        index = 1
+        pad = 1
         # iterate over sorted dict keys that the histograms have the same order all the time
         for channel in sorted(hists):
             hist = hists[channel]
-            canvas.cd(index)
+            canvas.cd(pad)
             if hist.IsA().GetName().startswith('TH1') and log1d:
                 if 'x' in log1d:
                     gPad.SetLogx()
@@ -785,9 +1357,14 @@ def main():
                     gPad.SetLogy()
                 if 'z' in log3d:
                     gPad.SetLogz()
-            hist.SetTitle(channel)
+            # channels of a sweep are prefixed with the variant name
+            scale = scale_factors.get(channel.rsplit('] ', 1)[-1])
+            if scale:
+                hist.SetTitle('%s (sample, scale by %.4g)' % (channel, scale))
+            else:
+                hist.SetTitle(channel)
             hist.Draw(style)
-            index += 1
+            pad += 1
         timestamp = datetime.datetime.now().strftime('_%Y-%m-%d_%H-%M')  # add timestamp to prevent overwriting existing files
         pdfname = get_path(output, name + timestamp + '.pdf')
         canvas.Update()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# vim: set ai ts=4 sw=4 sts=4 noet fileencoding=utf-8 ft=python
+
+'''
+This python script benchmarks the ROOT compression settings which can
+be used for merged files. The given files will be merged with hadd for
+every compression setting and the write time, the resulting file size
+as well as the time to read in all histograms of the merged file will
+be measured. Use it to choose the values of COMPRESSION_INTERMEDIATE
+and COMPRESSION_FINAL in analyse.py for your environment.
+
+See the help
+./benchmark_compression.py --help
+for more information how to use this script.
+'''
+
+import os, sys
+import csv
+import argparse
+import logging
+import tempfile
+from time import perf_counter
+from copy import copy
+
+from analyse import COMPRESSION_ALGORITHMS, compression_setting, get_root_entries, run, is_valid_dir
+from color import *
+
+
+logging.setLoggerClass(ColoredLogger)
+logger = logging.getLogger('Benchmark')
+
+
+def write_merged(files, merged, setting):
+    start = perf_counter()
+    with open(os.devnull, 'w') as log:
+        ret = run('hadd -f%d %s %s' % (setting, merged, ' '.join(files)), log, True)
+    return perf_counter() - start, ret
+
+def read_histograms(filename):
+    from ROOT import TFile
+    start = perf_counter()
+    current = TFile(filename)
+    if not current.IsOpen():
+        return None, 0
+    histograms = []
+    for entry in get_root_entries(current):
+        obj = current.Get(entry)
+        if obj.InheritsFrom('TH1'):
+            histograms.append(copy(obj))
+    current.Close()
+    return perf_counter() - start, len(histograms)
+
+def benchmark(files, settings, directory, repeat=3):
+    results = []
+    for name in settings:
+        setting = compression_setting(name)
+        merged = os.path.join(directory, 'benchmark_%d.root' % setting)
+        write_times, read_times = [], []
+        for _ in range(repeat):
+            write_time, ret = write_merged(files, merged, setting)
+            if ret:
+                logger.critical('Non-zero return code (%d) merging with setting %s' % (ret, name))
+                break
+            write_times.append(write_time)
+            read_time, n_hists = read_histograms(merged)
+            if read_time is None:
+                logger.critical('The merged file %s could not be opened' % merged)
+                break
+            read_times.append(read_time)
+        else:
+            results.append({
+                'setting': name,
+                'value': setting,
+                'size': os.path.getsize(merged),
+                'write': min(write_times),
+                'read': min(read_times),
+                'histograms': n_hists
+            })
+        if os.path.isfile(merged):
+            os.remove(merged)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ROOT compression settings for merged files')
+    parser.add_argument('files', nargs='+', metavar='file',
+            help='ROOT files which should be merged, e. g. the analysed files of one channel')
+    parser.add_argument('-s', '--settings', nargs='+', metavar='setting', default=sorted(COMPRESSION_ALGORITHMS),
+            help='compression settings which should be compared (default: %(default)s)')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+            help='number of repetitions per setting, the fastest one is reported (default: %(default)d)')
+    parser.add_argument('-t', '--tmp-dir', nargs=1, metavar='directory',
+            type=lambda x: is_valid_dir(parser, x),
+            help='directory for the merged files, choose it on the file system used in production')
+    parser.add_argument('-o', '--csv', nargs=1, metavar='file',
+            help='store the results additionally as CSV in the given file')
+
+    args = parser.parse_args()
+    for name in args.settings:
+        try:
+            compression_setting(name)
+        except ValueError as e:
+            parser.error(str(e))
+
+    directory = args.tmp_dir[0] if args.tmp_dir else None
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        results = benchmark(args.files, args.settings, tmp, max(args.repeat, 1))
+
+    if not results:
+        logger.error('No benchmark finished successfully')
+        sys.exit(1)
+
+    reference = max(res['size'] for res in results)
+    print('{0:<10s} {1:>6s} {2:>12s} {3:>7s} {4:>10s} {5:>10s}'.format('setting', 'value', 'size [kB]', 'ratio', 'write [s]', 'read [s]'))
+    for res in results:
+        print('{0:<10s} {1:>6d} {2:>12.1f} {3:>7.2f} {4:>10.3f} {5:>10.3f}'.format(res['setting'], res['value'],
+                res['size']/1024, res['size']/reference, res['write'], res['read']))
+
+    if args.csv:
+        with open(args.csv[0], 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['setting', 'value', 'size', 'write', 'read', 'histograms'])
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print()
+        logger.warning('Ctrl+C detected, will abort benchmark')
+        sys.exit(0)
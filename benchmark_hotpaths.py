@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# vim: set ai ts=4 sw=4 sts=4 noet fileencoding=utf-8 ft=python
+
+'''
+This python script benchmarks the helper functions of analyse.py which
+are run over the full file lists and the nested dicts of histograms, using
+synthetic file lists and histogram stacks. The results are stored as JSON
+together with the current git commit, so they can be compared to the
+results of an earlier commit to spot performance regressions.
+Linear-time replacements of the recursive flatten() are benchmarked
+as baselines as well.
+
+See the help
+./benchmark_hotpaths.py --help
+for more information how to use this script.
+'''
+
+import os, sys
+import json
+import argparse
+import logging
+import platform
+import tempfile
+import datetime
+import subprocess
+from time import perf_counter
+
+import analyse
+from color import *
+
+
+logging.setLoggerClass(ColoredLogger)
+logger = logging.getLogger('Benchmark')
+
+CHANNELS = ['etap_e+e-g', 'etap_mu+mu-g', 'etap_pi+pi-eta', 'eta_e+e-g', 'eta_pi+pi-pi0',
+        'omega_pi0g', 'omega_e+e-pi0', 'rho0_pi+pi-', 'pi0_e+e-g', 'pi0_gg']
+PATTERN = '^' + analyse.INPUT_FILE_PREFIX + r'_(.+)_\d+.root$'
+
+
+# linear-time baselines for analyse.flatten(), both leave the passed list untouched
+def flatten_iterative(lst):
+    flat = []
+    stack = [iter(lst)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, list):
+                stack.append(iter(item))
+                break
+            flat.append(item)
+        else:
+            stack.pop()
+    return flat
+
+def flatten_generator(lst):
+    def generate(items):
+        for item in items:
+            if isinstance(item, list):
+                yield from generate(item)
+            else:
+                yield item
+    return list(generate(lst))
+
+
+def file_list(size):
+    files = ['/data/%s_%s_%d.root' % (analyse.INPUT_FILE_PREFIX, CHANNELS[i % len(CHANNELS)], i) for i in range(size)]
+    # add a few files which don't match the pattern to fill the misc channel
+    files[::100] = ['/data/Physics_%d.root' % i for i in range(len(files[::100]))]
+    return files
+
+def nested_list(size):
+    # lists like [0, [1, [2, 3]], 4, [5, [6, 7]], ...] with a nesting depth of three
+    lst = []
+    for i in range(0, size, 4):
+        lst += [i, [i+1, [i+2, i+3]]]
+    return lst
+
+def histogram_dict(size):
+    # the structure of the histograms dict in analyse.main(): {plot: {channel: [files]}}
+    return dict(('hist_%d' % p, analyse.sort_channels(file_list(size//4), PATTERN)) for p in range(4))
+
+def dict_list(size):
+    return [analyse.sort_channels(file_list(size//4), PATTERN) for _ in range(4)]
+
+def channel_names(size):
+    return [CHANNELS[i % len(CHANNELS)] for i in range(size)]
+
+
+BENCHMARKS = [
+    ('sort_channels', lambda n: (file_list(n), PATTERN), analyse.sort_channels),
+    ('flatten', lambda n: (nested_list(n),), analyse.flatten),
+    ('flatten_iterative', lambda n: (nested_list(n),), flatten_iterative),
+    ('flatten_generator', lambda n: (nested_list(n),), flatten_generator),
+    ('get_all_dict_values', lambda n: (histogram_dict(n),), analyse.get_all_dict_values),
+    ('get_dict_values_from_list', lambda n: (dict_list(n),), analyse.get_dict_values_from_list),
+    ('format_channel', lambda n: (channel_names(n),), lambda names: [analyse.format_channel(name) for name in names]),
+]
+
+
+def root_benchmarks(directory):
+    '''
+    Benchmarks which need ROOT, an empty list is returned if ROOT can't be imported
+    '''
+    analyse.setup_root()
+    try:
+        from ROOT import gROOT, TFile, TH1, TH1D
+    except ImportError:
+        logger.warning('ROOT could not be imported, get_root_entries and merge_histograms will be skipped')
+        return []
+    gROOT.SetBatch(1)
+    TH1.AddDirectory(False)
+
+    def root_file(size):
+        # histograms distributed over nested directories like in the GoAT output
+        filename = os.path.join(directory, 'benchmark_%d.root' % size)
+        if not os.path.isfile(filename):
+            f = TFile(filename, 'RECREATE')
+            for d in range(10):
+                subdir = f.mkdir('dir_%d' % d).mkdir('sub')
+                subdir.cd()
+                for i in range(size//10):
+                    TH1D('h_%d_%d' % (d, i), '', 10, 0, 1).Write()
+            f.Close()
+        return filename
+
+    def get_root_entries(filename):
+        # opening the file is part of the measurement, this way no file is left open after a repetition
+        f = TFile(filename)
+        try:
+            return analyse.get_root_entries(f)
+        finally:
+            f.Close()
+
+    def histogram_stack(size):
+        stack = []
+        for i in range(size):
+            hist = TH1D('stack_%d' % i, '', 100, 0, 1)
+            hist.FillRandom('gaus', 100)
+            stack.append(hist)
+        return stack
+
+    return [
+        ('get_root_entries', lambda n: (root_file(n),), get_root_entries),
+        ('merge_histograms', lambda n: (histogram_stack(n),), analyse.merge_histograms),
+    ]
+
+
+def measure(func, make_args, size, repeat):
+    times = []
+    for _ in range(repeat):
+        # fresh input for every run
+        args = make_args(size)
+        start = perf_counter()
+        func(*args)
+        times.append(perf_counter() - start)
+    return min(times)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], universal_newlines=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(results, reference, threshold):
+    regressions = 0
+    print('\n{0:<28s} {1:>9s} {2:>12s} {3:>12s} {4:>7s}'.format('benchmark', 'size', 'before [s]', 'now [s]', 'ratio'))
+    for name, sizes in sorted(results.items()):
+        for size, seconds in sorted(sizes.items(), key=lambda x: int(x[0])):
+            before = reference.get(name, {}).get(size)
+            if not before:
+                continue
+            ratio = seconds/before
+            line = '{0:<28s} {1:>9s} {2:>12.6f} {3:>12.6f} {4:>7.2f}'.format(name, size, before, seconds, ratio)
+            if ratio > 1 + threshold:
+                regressions += 1
+                print_color(line + '  regression', RED)
+            else:
+                print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the in-Python hot paths of analyse.py')
+    parser.add_argument('-s', '--sizes', nargs='+', type=int, default=[3, 4, 5, 6], metavar='exponent',
+            help='exponents of the synthetic file list sizes (default: %(default)s, i. e. 10^3 to 10^6 files)')
+    parser.add_argument('-r', '--root-sizes', nargs='+', type=int, default=[100, 1000], metavar='size',
+            help='number of histograms for the ROOT benchmarks (default: %(default)s)')
+    parser.add_argument('-b', '--benchmarks', nargs='+', metavar='name',
+            help='only run the given benchmarks')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+            help='number of repetitions, the fastest one is reported (default: %(default)d)')
+    parser.add_argument('-o', '--output', nargs=1, metavar='file',
+            help='file to store the results as JSON (default: benchmark_<commit>.json)')
+    parser.add_argument('-c', '--compare', nargs=1, metavar='file',
+            type=lambda x: analyse.is_valid_file(parser, x),
+            help='results of an earlier run to compare with')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+            help='relative slowdown which is reported as regression (default: %(default)s)')
+
+    args = parser.parse_args()
+    commit = git_commit()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        benchmarks = [(name, make_args, func, [10**e for e in args.sizes]) for name, make_args, func in BENCHMARKS]
+        benchmarks += [(name, make_args, func, args.root_sizes) for name, make_args, func in root_benchmarks(tmp)]
+        if args.benchmarks:
+            benchmarks = [bench for bench in benchmarks if bench[0] in args.benchmarks]
+
+        print('{0:<28s} {1:>9s} {2:>12s}'.format('benchmark', 'size', 'time [s]'))
+        for name, make_args, func, sizes in benchmarks:
+            results[name] = {}
+            for size in sizes:
+                seconds = measure(func, make_args, size, max(args.repeat, 1))
+                results[name][str(size)] = seconds
+                print('{0:<28s} {1:>9d} {2:>12.6f}'.format(name, size, seconds))
+
+    output = args.output[0] if args.output else 'benchmark_%s.json' % commit
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'date': str(datetime.datetime.now()).split('.')[0],
+            'python': platform.python_version(),
+            'results': results
+        }, f, indent=2)
+    logger.info('Results written to %s' % output)
+
+    if args.compare:
+        reference = json.load(args.compare[0])
+        args.compare[0].close()
+        logger.info('Compare with commit %s' % reference.get('commit', 'unknown'))
+        if compare(results, reference.get('results', {}), args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print()
+        logger.warning('Ctrl+C detected, will abort benchmark')
+        sys.exit(0)
@@ -5,7 +5,7 @@ This module provides functions to color string in the terminal output
 and provides a logging class with colored strings
 '''
 
-__version__ = '1.0'
+__version__ = '1.1'
 
 # Colored output
 #The background is set with 40 plus the number of the color, and the foreground with 30
@@ -52,25 +52,57 @@ import sys
 def print_error(string):
     print(color_string(string, RED), file=sys.stderr)
 
+import re
+import json
+import time
+import queue
+import atexit
 import logging
+import threading
+import logging.handlers
+
+# all placeholders which can be used in the format string or the messages,
+# $COLOR depends on the level of the record and is handled separately
+TOKENS = {'$RESET': RESET_SEQ, '$BOLD': BOLD_SEQ}
+for k, v in COLORS.items():
+    TOKENS['$' + k] = COLOR_SEQ % (v+30)
+    TOKENS['$BG' + k] = COLOR_SEQ % (v+40)
+    TOKENS['$BG-' + k] = COLOR_SEQ % (v+40)
+# match longer placeholders first, e. g. $BG-RED before $BGRED
+TOKEN_REGEX = re.compile('|'.join(re.escape(t) for t in sorted(TOKENS, key=len, reverse=True)))
+LEVEL_COLORS = dict((k, COLOR_SEQ % (30 + v)) for k, v in COLORS.items())
+
+def replace_tokens(string):
+    return TOKEN_REGEX.sub(lambda match: TOKENS[match.group(0)], string)
+
+def strip_tokens(string):
+    return TOKEN_REGEX.sub('', string.replace('$COLOR', ''))
+
+def format_time(seconds=None):
+    '''
+    Format the given time (or the current time if None) in the
+    same way as the time stamps of the ColoredLogger
+    '''
+    return time.strftime(ColoredLogger.DATEFORMAT, time.localtime(seconds))
 
 class ColoredFormatter(logging.Formatter):
     def __init__(self, *args, **kwargs):
+        # the placeholders in the format string are the same for every record, replace them only once
+        if args and args[0]:
+            args = (replace_tokens(args[0]),) + args[1:]
+        elif kwargs.get('fmt'):
+            kwargs['fmt'] = replace_tokens(kwargs['fmt'])
         # can't do super(...) here because Formatter is an old school class
         logging.Formatter.__init__(self, *args, **kwargs)
 
     def format(self, record):
-        levelname = record.levelname
-        color     = COLOR_SEQ % (30 + COLORS[levelname])
+        levelname = record.levelname.strip()
         record.levelname = levelname.center(8)
         message   = logging.Formatter.format(self, record)
-        message   = message.replace("$RESET", RESET_SEQ)\
-                           .replace("$BOLD",  BOLD_SEQ)\
-                           .replace("$COLOR", color)
-        for k, v in COLORS.items():
-            message = message.replace("$" + k,    COLOR_SEQ % (v+30))\
-                             .replace("$BG" + k,  COLOR_SEQ % (v+40))\
-                             .replace("$BG-" + k, COLOR_SEQ % (v+40))
+        message   = message.replace("$COLOR", LEVEL_COLORS[levelname])
+        # only the message itself may contain further placeholders
+        if '$' in message:
+            message = replace_tokens(message)
         return message + RESET_SEQ
 
 # Custom logger class with multiple destinations
@@ -88,3 +120,103 @@ class ColoredLogger(logging.Logger):
         self.addHandler(console)
         return
 
+def enable_async_logging(logger):
+    '''
+    Move all handlers of the logger to a background thread, the records
+    are passed via a queue and formatted and written there
+    '''
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *logger.handlers, respect_handler_level=True)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    # make sure all records are written before the interpreter exits
+    atexit.register(listener.stop)
+    return listener
+
+class JsonLinesHandler(logging.Handler):
+    '''
+    Write the records as JSON lines to the given file, the records are
+    written in batches of batch_size or after interval seconds
+    '''
+    def __init__(self, filename, batch_size=100, interval=1.):
+        logging.Handler.__init__(self)
+        self.stream = open(filename, 'a')
+        self.batch_size = batch_size
+        self.interval = interval
+        self.buffer = []
+        self.last_write = time.time()
+
+    def emit(self, record):
+        try:
+            self.buffer.append(json.dumps({
+                'time': format_time(record.created),
+                'level': record.levelname.strip(),
+                'logger': record.name,
+                'message': strip_tokens(record.getMessage())
+            }))
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.buffer) >= self.batch_size or record.created - self.last_write >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer and self.stream:
+                self.stream.write('\n'.join(self.buffer) + '\n')
+                self.stream.flush()
+                self.buffer = []
+            self.last_write = time.time()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        self.acquire()
+        try:
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+class AsyncLogFile:
+    '''
+    File-like object which writes the given strings in a background thread,
+    flush() returns immediately as the data has already been handed over
+    '''
+    def __init__(self, filename, mode='a'):
+        self.name = filename
+        self._file = open(filename, mode)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._worker, name='AsyncLogFile', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _worker(self):
+        while True:
+            lines = [self._queue.get()]
+            # collect everything which is already waiting to write it at once
+            while not self._queue.empty():
+                lines.append(self._queue.get())
+            if None in lines:
+                self._file.write(''.join(lines[:lines.index(None)]))
+                self._file.close()
+                return
+            self._file.write(''.join(lines))
+            self._file.flush()
+
+    def write(self, string):
+        self._queue.put(string)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
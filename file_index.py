@@ -0,0 +1,78 @@
+# vim: set ai ts=4 sw=4 sts=4 noet fileencoding=utf-8 ft=python
+
+'''
+This module provides a cache for cheap per-file metadata, like the number
+of entries of the trees in a ROOT file, which is kept across runs. Every
+record is stored together with the size and modification time of the file
+and is only used as long as those haven't changed.
+'''
+
+__version__ = '1.0'
+
+import os
+import json
+import threading
+
+class FileIndex:
+    def __init__(self, filename):
+        self.filename = os.path.expanduser(filename)
+        self._records = {}
+        self._changed = False
+        self._lock = threading.Lock()
+        if os.path.isfile(self.filename):
+            try:
+                with open(self.filename, 'r') as f:
+                    self._records = json.load(f)
+            except (IOError, ValueError):
+                # a broken index is simply rebuilt
+                self._records = {}
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(os.path.expanduser(path))
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(os.path.expanduser(path))
+        except OSError:
+            return None, None
+        return stat.st_size, stat.st_mtime
+
+    def get(self, path, field=None):
+        '''
+        Return the record of the given file or only the given field of it,
+        None if the file isn't indexed or changed since it has been indexed
+        '''
+        size, mtime = self._stat(path)
+        with self._lock:
+            record = self._records.get(self._key(path))
+        if not record or record['size'] != size or record['mtime'] != mtime:
+            return None
+        if field:
+            return record.get(field)
+        return record
+
+    def update(self, path, **fields):
+        size, mtime = self._stat(path)
+        if size is None:
+            return
+        key = self._key(path)
+        with self._lock:
+            record = self._records.get(key)
+            if not record or record['size'] != size or record['mtime'] != mtime:
+                record = {'size': size, 'mtime': mtime}
+                self._records[key] = record
+            record.update(fields)
+            self._changed = True
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            # write to a temporary file first that the index doesn't get corrupted
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._records, f)
+            os.replace(tmp, self.filename)
+            self._changed = False
@@ -0,0 +1,104 @@
+# vim: set ai ts=4 sw=4 sts=4 noet fileencoding=utf-8 ft=python
+
+'''
+This module provides a pre-flight check of ROOT files. Only the file header,
+the top directory record and the key list header are read with plain Python,
+hence the files can be checked in parallel without loading ROOT. Files which
+are too small, truncated, haven't been closed properly (zombies) or don't
+contain any keys are reported and can be moved to a quarantine directory.
+'''
+
+__version__ = '1.0'
+
+import os
+import struct
+from shutil import move
+from concurrent.futures import ThreadPoolExecutor
+
+def check_root_file(path, min_size=0):
+    '''
+    Return None if the file looks fine, otherwise the reason why it doesn't
+    '''
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 'not readable'
+    if size < min_size:
+        return 'too small (%d bytes)' % size
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(64)
+            if header[:4] != b'root':
+                return 'no ROOT file'
+            version, begin = struct.unpack('>ii', header[4:12])
+            # files larger than 2GB use 64 bit pointers
+            if version >= 1000000:
+                end, = struct.unpack('>q', header[12:20])
+                nbytes_name, = struct.unpack('>i', header[36:40])
+            else:
+                end, = struct.unpack('>i', header[12:16])
+                nbytes_name, = struct.unpack('>i', header[28:32])
+            if end > size:
+                return 'truncated (%d of %d bytes)' % (size, end)
+            # the record of the top directory follows the name and title of the file
+            f.seek(begin + nbytes_name)
+            directory = f.read(42)
+            dir_version, = struct.unpack('>h', directory[:2])
+            if dir_version > 1000:
+                seek_keys, = struct.unpack('>q', directory[34:42])
+            else:
+                seek_keys, = struct.unpack('>i', directory[26:30])
+            if not seek_keys or seek_keys >= size:
+                return 'not closed properly'
+            # the number of keys follows the header of the key list
+            f.seek(seek_keys)
+            key_length, = struct.unpack('>h', f.read(16)[14:16])
+            f.seek(seek_keys + key_length)
+            n_keys, = struct.unpack('>i', f.read(4))
+    except (IOError, OSError, struct.error):
+        return 'unreadable header'
+    if n_keys <= 0:
+        return 'no keys'
+    return None
+
+def preflight(files, index=None, min_size=0, jobs=None, progress=None):
+    '''
+    Check all files in parallel and return a dict with the bad files and the
+    reason; the results are cached in the given FileIndex
+    '''
+    results = {}
+    unchecked = []
+    for filename in files:
+        reason = index.get(filename, 'preflight') if index else None
+        if reason is None:
+            unchecked.append(filename)
+        elif reason:
+            results[filename] = reason
+
+    if progress:
+        progress.add('discovery', {'files': len(unchecked)})
+
+    with ThreadPoolExecutor(max_workers=jobs or min(32, (os.cpu_count() or 1) * 4)) as executor:
+        for filename, reason in zip(unchecked, executor.map(lambda f: check_root_file(f, min_size), unchecked)):
+            if progress:
+                progress.job_done('files')
+            if index:
+                # an empty string marks a file which passed the check
+                index.update(filename, preflight=reason or '')
+            if reason:
+                results[filename] = reason
+
+    return results
+
+def quarantine_files(bad_files, report, directory=None):
+    '''
+    Write the bad files with the reason to the report and move
+    them to the quarantine directory if one is given
+    '''
+    with open(report, 'w') as f:
+        for filename in sorted(bad_files):
+            destination = filename
+            if directory:
+                destination = os.path.join(directory, os.path.basename(filename))
+                move(filename, destination)
+            f.write('%s\t%s\n' % (destination, bad_files[filename]))
@@ -0,0 +1,175 @@
+# vim: set ai ts=4 sw=4 sts=4 noet fileencoding=utf-8 ft=python
+
+'''
+This module provides a progress display for the different stages of the
+analysis. It shows the number of processed files per channel, the
+throughput as moving average over the last finished jobs, an estimate of
+the remaining time and the currently running jobs. On a terminal a single
+line is updated, otherwise JSON status lines are written periodically.
+'''
+
+__version__ = '1.0'
+
+import sys
+import json
+import time
+import logging
+import threading
+from shutil import get_terminal_size
+from collections import deque
+
+def format_duration(seconds):
+    if seconds is None:
+        return '--:--:--'
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class Progress:
+    def __init__(self, stream=sys.stderr, interval=None, window=20):
+        self.stream = stream
+        self.tty = stream.isatty()
+        # a terminal line can be updated often, status lines should be rare
+        if interval is None:
+            interval = 0.2 if self.tty else 10.
+        self.interval = interval
+        self.window = window
+        self.stage = None
+        self._lock = threading.RLock()
+        self._last_render = 0
+        self._line = False
+        self._written = None
+        self._ticker = None
+        self._stop = threading.Event()
+
+    def add(self, stage, totals):
+        '''
+        Add the number of files per channel to the given stage,
+        a different stage than the current one starts a new stage
+        '''
+        with self._lock:
+            if stage != self.stage:
+                self._finish_stage()
+                self.stage = stage
+                self.totals = {}
+                self.done = {}
+                self.running = []
+                # completed jobs as (time, files, bytes), starting with the beginning of the stage
+                self._history = deque([(time.time(), 0, 0)], maxlen=self.window + 1)
+                self._start = time.time()
+            for channel, total in totals.items():
+                self.totals[channel] = self.totals.get(channel, 0) + total
+                self.done.setdefault(channel, 0)
+            self.render(True)
+            # update the status regularly, also while a single long job is running
+            if not self._ticker:
+                self._stop.clear()
+                self._ticker = threading.Thread(target=self._tick, name='Progress', daemon=True)
+                self._ticker.start()
+
+    def _tick(self):
+        while not self._stop.wait(self.interval):
+            self.render(True)
+
+    def job_started(self, name):
+        with self._lock:
+            self.running.append(name)
+            self.render()
+
+    def job_done(self, channel, name=None, nbytes=0, files=1):
+        with self._lock:
+            if name in self.running:
+                self.running.remove(name)
+            self.done[channel] = self.done.get(channel, 0) + files
+            self._history.append((time.time(), files, nbytes))
+            self.render(sum(self.done.values()) == sum(self.totals.values()))
+
+    def status(self):
+        with self._lock:
+            done, total = sum(self.done.values()), sum(self.totals.values())
+            now = time.time()
+            # the rate drops while no job finishes, this way the ETA grows during a long job
+            elapsed = (self._history[-1][0] if done == total else now) - self._history[0][0]
+            files = sum(entry[1] for entry in list(self._history)[1:])
+            nbytes = sum(entry[2] for entry in list(self._history)[1:])
+            rate = files/elapsed if elapsed > 0 else 0.
+            return {
+                'stage': self.stage,
+                'done': done,
+                'total': total,
+                'elapsed_s': round(now - self._start),
+                'channels': dict((channel, [self.done[channel], self.totals[channel]]) for channel in sorted(self.totals)),
+                'files_per_s': round(rate, 3),
+                'mb_per_s': round(nbytes/elapsed/1e6, 3) if elapsed > 0 else 0.,
+                'eta_s': round((total - done)/rate) if rate else None,
+                'running': list(self.running)
+            }
+
+    def render(self, force=False):
+        with self._lock:
+            if not self.stage or not force and time.time() - self._last_render < self.interval:
+                return
+            self._last_render = time.time()
+            status = self.status()
+            self._written = (status['stage'], status['done'], status['total'])
+            if not self.tty:
+                self.stream.write(json.dumps(status) + '\n')
+                self.stream.flush()
+                return
+            channels = ' '.join('%s %d/%d' % (channel, done, total) for channel, (done, total) in status['channels'].items())
+            line = '[%s] %d/%d | %.2f files/s %.1f MB/s | ETA %s | %s' % (status['stage'], status['done'], status['total'],
+                    status['files_per_s'], status['mb_per_s'], format_duration(status['eta_s']), channels)
+            if status['running']:
+                line += ' | running: ' + ', '.join(status['running'])
+            self.stream.write('\r\033[K' + line[:get_terminal_size().columns - 1])
+            self.stream.flush()
+            self._line = True
+
+    def clear(self):
+        with self._lock:
+            if self._line:
+                self.stream.write('\r\033[K')
+                self.stream.flush()
+                self._line = False
+
+    def _finish_stage(self):
+        if not self.stage:
+            return
+        # don't repeat the status of a finished stage which has just been written
+        if self.tty or self._written != (self.stage, sum(self.done.values()), sum(self.totals.values())):
+            self.render(True)
+        if self._line:
+            self.stream.write('\n')
+            self.stream.flush()
+            self._line = False
+
+    def finish(self):
+        self._stop.set()
+        if self._ticker:
+            self._ticker.join()
+            self._ticker = None
+        with self._lock:
+            self._finish_stage()
+            self.stage = None
+
+class ProgressHandler(logging.Handler):
+    '''
+    Wrap a handler which writes to the same stream as the progress display,
+    the progress line is removed before a record is printed and isn't drawn
+    again until the record has been written; it will be drawn with the next update
+    '''
+    def __init__(self, handler, progress):
+        logging.Handler.__init__(self, handler.level)
+        self.handler = handler
+        self.progress = progress
+
+    def emit(self, record):
+        with self.progress._lock:
+            self.progress.clear()
+            self.handler.handle(record)
+
+    def flush(self):
+        self.handler.flush()
+
+    def close(self):
+        self.handler.close()
+        logging.Handler.close(self)
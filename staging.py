@@ -0,0 +1,191 @@
+# vim: set ai ts=4 sw=4 sts=4 noet fileencoding=utf-8 ft=python
+
+'''
+This module provides a staging layer for input files located on a network
+file system. The files are copied to a local scratch directory ahead of the
+jobs which need them, outputs are written locally and moved atomically to
+their final destination afterwards.
+'''
+
+__version__ = '1.0'
+
+import os
+import re
+import atexit
+import tempfile
+import threading
+from shutil import copyfile, rmtree
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parse_size(size):
+    '''
+    Convert a size like '500M' or '20G' to bytes
+    '''
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kKmMgGtT]?)i?[bB]?\s*$', str(size))
+    if not match:
+        raise ValueError("Invalid size '%s'" % size)
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+class Stager:
+    '''
+    Prefetch the next files of a scheduled list to a local scratch directory.
+    Files have to be requested via fetch() in the order they were scheduled
+    and should be released via release() as soon as the job is done. The
+    quota limits the space used on scratch: staged input files plus the space
+    reserved for their outputs, output_factor times the size of the input.
+    A file which doesn't fit into the quota together with its output isn't
+    staged, it is read from its original location. Outputs of merges, which
+    are about as large as all their inputs together, are written next to
+    their destination instead.
+    '''
+    def __init__(self, scratch, prefetch=2, quota=0, output_factor=1.):
+        scratch = os.path.expanduser(scratch)
+        if not os.path.isdir(scratch):
+            os.makedirs(scratch)
+        self.directory = tempfile.mkdtemp(prefix='staging_', dir=scratch)
+        self.input_directory = os.path.join(self.directory, 'input')
+        self.output_directory = os.path.join(self.directory, 'output')
+        os.mkdir(self.input_directory)
+        os.mkdir(self.output_directory)
+        self.prefetch = max(prefetch, 1)
+        self.quota = quota
+        self.output_factor = output_factor
+        self._queue = []
+        self._position = {}
+        self._staged = {}
+        self._sizes = {}
+        self._reserved = {}
+        self._outputs = {}
+        self._used = 0
+        self._requested = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+        atexit.register(self.close)
+
+    def schedule(self, files):
+        with self._cond:
+            for filename in files:
+                self._position[filename] = len(self._queue)
+                self._queue.append(filename)
+            self._cond.notify_all()
+        if not self._thread:
+            self._thread = threading.Thread(target=self._worker, name='Stager', daemon=True)
+            self._thread.start()
+
+    def _local_path(self, filename, index):
+        # prepend the position to avoid collisions of files with the same name in different directories
+        return os.path.join(self.input_directory, '%d_%s' % (index, os.path.basename(filename)))
+
+    def _worker(self):
+        index = 0
+        while True:
+            with self._cond:
+                while not self._closed and (index >= len(self._queue) or index >= self._requested + self.prefetch):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                filename = self._queue[index]
+                try:
+                    size = os.path.getsize(filename)
+                except OSError:
+                    size = None
+                # reserve the space for the output of the job together with the input
+                reserved = int(size * self.output_factor) if size else 0
+                # files which don't fit into the quota at all are read from their original location
+                fits = not self.quota or size is None or size + reserved <= self.quota
+                while fits and size and not self._closed and self.quota and self._used + size + reserved > self.quota:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                if fits and size is not None:
+                    self._used += size + reserved
+            local = self._local_path(filename, index) if fits else None
+            if local:
+                try:
+                    copyfile(filename, local)
+                except (IOError, OSError):
+                    local = None
+            with self._cond:
+                if local:
+                    self._sizes[filename] = size
+                    self._reserved[filename] = reserved
+                elif fits and size is not None:
+                    self._used -= size + reserved
+                # None marks files which couldn't be staged, they will be read from their original location
+                self._staged[filename] = local
+                self._cond.notify_all()
+            index += 1
+
+    def fetch(self, filename):
+        '''
+        Return the local path of a scheduled file, wait until it is staged if necessary
+        '''
+        with self._cond:
+            if filename not in self._position:
+                return filename
+            self._requested = max(self._requested, self._position[filename] + 1)
+            self._cond.notify_all()
+            while filename not in self._staged and not self._closed:
+                self._cond.wait()
+            return self._staged.get(filename) or filename
+
+    def release(self, filename):
+        with self._cond:
+            local = self._staged.pop(filename, None)
+            if local and os.path.isfile(local):
+                os.remove(local)
+            self._used -= self._sizes.pop(filename, 0)
+            # a reservation which hasn't been assigned to an output isn't needed anymore
+            self._used -= self._reserved.pop(filename, 0)
+            self._cond.notify_all()
+
+    def local_output(self, filename, input_file=None):
+        '''
+        Return the path on scratch to write the given output file to, the
+        space reserved for the output of the input file is assigned to it; the
+        output of an input file which hasn't been staged is written next to
+        the destination, no space has been reserved for it
+        '''
+        local = os.path.join(self.output_directory, os.path.basename(filename))
+        with self._cond:
+            if input_file is not None and input_file not in self._reserved:
+                return self.partial_output(filename)
+            self._outputs[local] = self._outputs.get(local, 0) + self._reserved.pop(input_file, 0)
+        return local
+
+    def partial_output(self, filename):
+        '''
+        Return the path next to the destination for outputs which shouldn't use scratch
+        '''
+        return filename + '.part'
+
+    def commit(self, local, destination):
+        '''
+        Move a written output file atomically to its destination, a file on
+        scratch is copied next to the destination first and renamed afterwards
+        '''
+        try:
+            if not os.path.isfile(local):
+                return False
+            tmp = destination + '.part'
+            if local != tmp:
+                copyfile(local, tmp)
+                os.remove(local)
+            os.replace(tmp, destination)
+            return True
+        finally:
+            with self._cond:
+                self._used -= self._outputs.pop(local, 0)
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        rmtree(self.directory, ignore_errors=True)